@@ -1,5 +1,6 @@
 from pymilvus import MilvusClient
 
+# Connects over gRPC; the http:// scheme only selects a plaintext channel
 client = MilvusClient("http://localhost:19530")
 
 # List all collections
@@ -11,16 +12,27 @@ collection_name = "semantic_search_demo"
 stats = client.get_collection_stats(collection_name)
 print("\nCollection stats:", stats)
 
-# Query all records (limit to first 10)
-results = client.query(
+# Make sure the collection is loaded into memory before querying
+client.load_collection(collection_name)
+
+# Stream the first records with a pk-paged iterator instead of a full scan
+sample_limit = 10
+iterator = client.query_iterator(
     collection_name=collection_name,
-    filter="",  # empty filter means get all
-    output_fields=["id", "text"],
-    limit=10,
+    batch_size=min(100, sample_limit),
+    limit=sample_limit,
+    output_fields=["id", "text"],  # never fetch the vectors here
 )
 print("\nSample records:")
-for record in results:
-    print(f"ID: {record['id']}, Text: {record['text']}")
+try:
+    while True:
+        batch = iterator.next()
+        if not batch:
+            break
+        for record in batch:
+            print(f"ID: {record['id']}, Text: {record['text']}")
+finally:
+    iterator.close()
 
 # Get collection schema
 schema = client.describe_collection(collection_name)
@@ -1,38 +1,293 @@
-from openai import OpenAI
+from openai import (
+    APIStatusError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    RateLimitError,
+)
 from pymilvus import MilvusClient
 import os
-from dotenv import dotenv_values
-from typing import List, Dict
+import time
+import asyncio
+import functools
+import httpx
+import numpy as np
+import tiktoken
+from collections import OrderedDict
+from dotenv import load_dotenv
+from typing import List, Dict, Iterator, Optional, Tuple, Callable, Awaitable, Set
 
-config = dotenv_values(".env")
+# Variables already set in the process environment take precedence over .env
+load_dotenv(".env")
 
-OPENAI_API_KEY = config["OPENAI_API_KEY"]
-OPENAI_BASE_URL = config["OPENAI_BASE_URL"]
+OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL")  # None uses the default API
 
+# pymilvus always talks gRPC to port 19530; the http:// scheme only means no TLS
+# (it is not the REST gateway, and pymilvus rejects a grpc:// scheme)
+MILVUS_URI = "http://localhost:19530"
 
-class SemanticSearch:
-    def __init__(self):
-        # Initialize OpenAI client
-        self.openai_client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
-
-        # Initialize Milvus client (standalone)
-        self.milvus_client = MilvusClient(
-            uri="http://localhost:19530",  # Added 'http://' prefix to URI
-            # user=os.getenv("MILVUS_USER", ""),  # Optional
-            # password=os.getenv("MILVUS_PASSWORD", ""),  # Optional
+# Seconds a has_collection result is trusted before asking Milvus again
+COLLECTION_CACHE_TTL = 30.0
+# (uri, collection name) -> (checked at, exists)
+_COLLECTION_CACHE: Dict[Tuple[str, str], Tuple[float, bool]] = {}
+
+def create_openai_client() -> AsyncOpenAI:
+    """
+    OpenAI client with a keep-alive HTTP/2 connection pool
+    Its connections belong to the event loop that opens them, so share it only
+    within one loop and `await client.close()` before that loop ends
+    """
+    return AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        base_url=OPENAI_BASE_URL,
+        http_client=DefaultAsyncHttpxClient(
+            http2=True, limits=httpx.Limits(max_keepalive_connections=10)
+        ),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_milvus_client(uri: str = MILVUS_URI) -> MilvusClient:
+    """Shared Milvus client per URI; MilvusClient is safe to use across threads"""
+    return MilvusClient(
+        uri=uri,
+        # user=os.getenv("MILVUS_USER", ""),  # Optional
+        # password=os.getenv("MILVUS_PASSWORD", ""),  # Optional
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Tokenizer for an embedding model, loaded once per process"""
+    return tiktoken.encoding_for_model(model)
+
+
+def normalize(embedding: List[float]) -> np.ndarray:
+    """L2-normalize an embedding so inner product equals cosine similarity"""
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class SemanticCache:
+    """
+    In-process cache of search results keyed by query embedding
+    A lookup hits when a cached query's cosine similarity is at least threshold
+    """
+
+    def __init__(
+        self,
+        dimension: int,
+        max_size: int = 1024,
+        threshold: float = 0.97,
+        ttl: float = 300.0,
+    ):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        self.size = 0
+        # L2-normalized query embeddings, one row per cached query
+        self.vectors = np.zeros((max_size, dimension), dtype=np.float32)
+        self.limits = np.zeros(max_size, dtype=np.int64)
+        self.created = np.zeros(max_size)
+        self.last_used = np.zeros(max_size)
+        self.results: List[Optional[List[Dict]]] = [None] * max_size
+        # Reused output buffer for similarity scores, avoids a per-lookup allocation
+        self._scores = np.empty(max_size, dtype=np.float32)
+
+    def get(self, embedding: np.ndarray, limit: int) -> Optional[List[Dict]]:
+        """
+        Return cached results for a near-identical query, if any
+        embedding: L2-normalized float32 query vector
+        """
+        if not self.size:
+            return None
+
+        now = time.monotonic()
+        # Cosine similarity against every cached query as one float32 BLAS SGEMV
+        scores = np.matmul(
+            self.vectors[: self.size], embedding, out=self._scores[: self.size]
         )
+        # Skip stale entries and ones cached with too few results
+        scores[now - self.created[: self.size] > self.ttl] = -np.inf
+        scores[self.limits[: self.size] < limit] = -np.inf
+
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        self.last_used[best] = now
+        return self._copy_hits(self.results[best][:limit])
+
+    def put(self, embedding: np.ndarray, limit: int, results: List[Dict]):
+        """
+        Cache results for a query, evicting the least recently used entry
+        embedding: L2-normalized float32 query vector
+        """
+        if self.size < self.max_size:
+            slot = self.size
+            self.size += 1
+        else:
+            slot = int(np.argmin(self.last_used))
+
+        now = time.monotonic()
+        self.vectors[slot] = embedding
+        self.limits[slot] = limit
+        self.created[slot] = now
+        self.last_used[slot] = now
+        self.results[slot] = self._copy_hits(results)
+
+    @staticmethod
+    def _copy_hits(hits: List[Dict]) -> List[Dict]:
+        """Copy hits and their entity dicts, so callers can't alter cached results"""
+        return [
+            {
+                key: dict(value) if isinstance(value, dict) else value
+                for key, value in hit.items()
+            }
+            for hit in hits
+        ]
+
+    def clear(self):
+        """Drop all cached results, e.g. after the collection changes"""
+        self.size = 0
+        self.results = [None] * self.max_size
+
+
+class VectorManager:
+    """
+    Coalesces concurrent embedding requests into batched API calls
+    Texts submitted within window_ms of the first pending one share a request
+    """
+
+    def __init__(
+        self,
+        embed_batch: Callable[[List[str]], Awaitable[np.ndarray]],
+        window_ms: float = 50,
+        max_batch: int = 2048,
+    ):
+        self.embed_batch = embed_batch
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_timer: Optional[asyncio.Task] = None
+        # Hold references to in-flight requests so they aren't garbage collected
+        self._requests: Set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> np.ndarray:
+        """Get embedding for a text, batched with other concurrent callers"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.create_task(self._flush_after_window())
+        return await future
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window)
+        self._flush_timer = None
+        self._flush()
+
+    def _flush(self):
+        """Send all pending texts as one request"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        request = asyncio.create_task(self._resolve(pending))
+        self._requests.add(request)
+        request.add_done_callback(self._requests.discard)
+
+    async def _resolve(self, pending: List[Tuple[str, asyncio.Future]]):
+        try:
+            vectors = await self.embed_batch([text for text, _ in pending])
+        except BaseException as e:
+            # Complete every waiter, including on cancellation, so none hangs
+            for _, future in pending:
+                if future.done():
+                    continue
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        if len(vectors) != len(pending):
+            # Rows are matched to texts by position, so a short response can't
+            # be trusted for any of them
+            error = RuntimeError(
+                f"Expected {len(pending)} embeddings, got {len(vectors)}"
+            )
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), vector in zip(pending, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+
+class SemanticSearch:
+    def __init__(self, openai_client: Optional[AsyncOpenAI] = None):
+        # Share the caller's OpenAI client, or own one that close() shuts down
+        self._owns_openai_client = openai_client is None
+        self.openai_client = openai_client or create_openai_client()
+
+        # Reuse the shared Milvus client (standalone)
+        self.milvus_client = get_milvus_client(MILVUS_URI)
 
         # Constants
         self.COLLECTION_NAME = "semantic_search_demo"
         self.EMBEDDING_MODEL = "text-embedding-3-small"
         self.DIMENSION = 1536  # Dimension for text-embedding-3-small model
+        self.MAX_BATCH_ITEMS = 2048  # OpenAI limit on inputs per request
+        self.MAX_BATCH_TOKENS = 8000  # Stay under the per-request token limit
+        self.MAX_RETRIES = 5
+        self.MAX_INSERT_ROWS = 1000  # Rows per Milvus insert call
+        self.MAX_CONCURRENT_REQUESTS = 8  # Parallel embedding requests in flight
+        self.QUERY_CACHE_SIZE = 1024
+        self.QUERY_CACHE_TTL = 300.0  # Seconds before cached entries go stale
+        self.HNSW_M = 16  # Graph degree of the HNSW index
+        self.HNSW_EF_CONSTRUCTION = 200  # Build-time candidate list size
+        self.HNSW_EF = 64  # Search-time candidate list size, trades recall for speed
+        self.EMBED_WINDOW_MS = 50  # How long to gather concurrent query embeddings
+
+        # Exact-match cache of query embeddings, keyed on (model, text)
+        self._embedding_cache: OrderedDict = OrderedDict()
+        # Similarity-match cache of search results for paraphrased queries
+        self.semantic_cache = SemanticCache(
+            self.DIMENSION,
+            max_size=self.QUERY_CACHE_SIZE,
+            threshold=0.97,
+            ttl=self.QUERY_CACHE_TTL,
+        )
+        # Batches query embeddings from concurrent searches into one request
+        self.vector_manager = VectorManager(
+            self._embed_batch,
+            window_ms=self.EMBED_WINDOW_MS,
+            max_batch=self.MAX_BATCH_ITEMS,
+        )
 
         # Create collection if it doesn't exist
         self._initialize_collection()
 
+    async def __aenter__(self) -> "SemanticSearch":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Close the OpenAI client and its connections, if this instance owns it"""
+        if self._owns_openai_client:
+            await self.openai_client.close()
+
     def _initialize_collection(self):
         """Initialize Milvus collection if it doesn't exist"""
-        if self.milvus_client.has_collection(self.COLLECTION_NAME):
+        if self._collection_exists():
             print(f"Collection {self.COLLECTION_NAME} already exists")
             return
 
@@ -42,61 +297,287 @@ class SemanticSearch:
             dimension=self.DIMENSION,
             primary_field="id",
             vector_field="vector",  # Changed from 'embedding' to 'vector'
+            metric_type="IP",  # Vectors are normalized, so IP equals cosine
         )
+        self._create_index()
+        # Only record the collection once it is fully set up, so a failed index
+        # build is retried by the next instance
+        _COLLECTION_CACHE[(MILVUS_URI, self.COLLECTION_NAME)] = (time.monotonic(), True)
         print(f"Created collection {self.COLLECTION_NAME}")
 
-    def _get_embedding(self, text: str) -> List[float]:
-        """Get embedding for a text using OpenAI's API"""
-        response = self.openai_client.embeddings.create(
-            input=text, model=self.EMBEDDING_MODEL
+    def _create_index(self):
+        """Replace the default vector index with a tuned HNSW index"""
+        # Quick-setup collections come loaded with a default index on 'vector'
+        self.milvus_client.release_collection(self.COLLECTION_NAME)
+        for index_name in self.milvus_client.list_indexes(
+            self.COLLECTION_NAME, field_name="vector"
+        ):
+            self.milvus_client.drop_index(self.COLLECTION_NAME, index_name)
+
+        index_params = self.milvus_client.prepare_index_params()
+        index_params.add_index(
+            field_name="vector",
+            index_type="HNSW",
+            metric_type="IP",
+            params={"M": self.HNSW_M, "efConstruction": self.HNSW_EF_CONSTRUCTION},
         )
-        return response.data[0].embedding
+        self.milvus_client.create_index(self.COLLECTION_NAME, index_params)
+        self.milvus_client.load_collection(self.COLLECTION_NAME)
+
+    def _collection_exists(self) -> bool:
+        """Check whether the collection exists, memoized for COLLECTION_CACHE_TTL"""
+        key = (MILVUS_URI, self.COLLECTION_NAME)
+        now = time.monotonic()
+        cached = _COLLECTION_CACHE.get(key)
+        if cached is not None and now - cached[0] <= COLLECTION_CACHE_TTL:
+            return cached[1]
+
+        exists = self.milvus_client.has_collection(self.COLLECTION_NAME)
+        _COLLECTION_CACHE[key] = (now, exists)
+        return exists
 
-    def add_documents(self, documents: List[Dict[str, str]]):
+    async def _get_query_embedding(self, query: str) -> np.ndarray:
+        """Get embedding for a query, reusing it if the same query was seen"""
+        key = (self.EMBEDDING_MODEL, query)
+        now = time.monotonic()
+        cached = self._embedding_cache.get(key)
+        if cached is not None and now - cached[0] <= self.QUERY_CACHE_TTL:
+            self._embedding_cache.move_to_end(key)
+            return cached[1]
+
+        embedding = await self.vector_manager.embed(query)
+        self._embedding_cache[key] = (now, embedding)
+        self._embedding_cache.move_to_end(key)
+        if len(self._embedding_cache) > self.QUERY_CACHE_SIZE:
+            self._embedding_cache.popitem(last=False)  # Evict least recently used
+        return embedding
+
+    async def _get_embeddings(self, texts: List[str]) -> np.ndarray:
+        """
+        Get embeddings for several texts with a single OpenAI API call
+        Returns a float32 array with one row per text
+        """
+        response = await self.openai_client.embeddings.create(
+            input=texts, model=self.EMBEDDING_MODEL
+        )
+        # Results carry the position of their input; keep them in input order
+        return np.array(
+            [item.embedding for item in sorted(response.data, key=lambda d: d.index)],
+            dtype=np.float32,
+        )
+
+    def _pack_batches(
+        self, texts: List[str], max_items: int, max_tokens: int
+    ) -> Iterator[List[str]]:
+        """
+        Greedily pack texts into batches bounded by item count and token budget
+        texts: Texts to pack, kept in their original order
+        """
+        encoding = get_encoding(self.EMBEDDING_MODEL)
+        batch, batch_tokens = [], 0
+        for text in texts:
+            # Plain text needs no special-token handling, which encode would scan for
+            tokens = len(encoding.encode_ordinary(text))
+            if batch and (
+                len(batch) >= max_items or batch_tokens + tokens > max_tokens
+            ):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    async def _embed_batch(self, texts: List[str], attempt: int = 0) -> np.ndarray:
+        """
+        Embed a batch, retrying on rate limits and splitting it in half if it
+        is too large
+        """
+        try:
+            return await self._get_embeddings(texts)
+        except RateLimitError:
+            if attempt >= self.MAX_RETRIES:
+                raise
+            await asyncio.sleep(2**attempt)  # Exponential backoff before retrying
+            return await self._embed_batch(texts, attempt + 1)
+        except APIStatusError as e:
+            # Splitting only helps when the batch was rejected for its size, and
+            # a single text can't be split any further
+            if not self._is_too_large(e) or len(texts) == 1:
+                raise
+            # A size rejection isn't transient, so retry the halves right away
+            middle = len(texts) // 2
+            first = await self._embed_batch(texts[:middle], attempt)
+            second = await self._embed_batch(texts[middle:], attempt)
+            return np.concatenate([first, second])
+
+    @staticmethod
+    def _is_too_large(error: APIStatusError) -> bool:
+        """Whether the API rejected a request for exceeding its size limits"""
+        if error.status_code == 413:  # Payload too large
+            return True
+        message = str(error.message).lower()
+        return (
+            error.code == "context_length_exceeded"
+            or "maximum context length" in message
+            or "too long" in message
+        )
+
+    async def _embed_texts(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed any number of texts in size-capped batches sent concurrently
+        Returns a normalized float32 array with one row per text, in order
+        """
+        # Tokenizing every text is CPU-bound, so pack in a thread to keep the
+        # event loop serving other callers
+        batches = await asyncio.to_thread(
+            list,
+            self._pack_batches(texts, self.MAX_BATCH_ITEMS, self.MAX_BATCH_TOKENS),
+        )
+
+        # Embed all batches concurrently, capped to respect rate limits
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+
+        async def embed(batch: List[str]) -> np.ndarray:
+            async with semaphore:
+                return await self._embed_batch(batch)
+
+        # gather keeps results in batch order, so they line up with texts
+        batch_embeddings = await asyncio.gather(*[embed(b) for b in batches])
+
+        # One contiguous (N, DIMENSION) float32 matrix, normalized row-wise in place
+        vectors = np.concatenate(batch_embeddings)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+    async def add_documents(self, documents: List[Dict[str, str]]):
         """
         Add documents to the semantic search index
         documents: List of dicts with 'id' and 'text' keys
         """
-        for doc in documents:
-            # Get embedding for the document
-            embedding = self._get_embedding(doc["text"])
+        if not documents:
+            return
+
+        vectors = await self._embed_texts([doc["text"] for doc in documents])
+
+        # Build every row up front, right next to the embedding batch
+        rows = [
+            {"id": doc["id"], "vector": vector, "text": doc["text"]}
+            for doc, vector in zip(documents, vectors)
+        ]
 
-            # Insert into Milvus without wrapping embedding in a list
-            self.milvus_client.insert(
+        # Insert rows in bulk, chunked to stay under the gRPC message size limit;
+        # blocking Milvus calls run in a thread so the event loop keeps serving
+        for start in range(0, len(rows), self.MAX_INSERT_ROWS):
+            await asyncio.to_thread(
+                self.milvus_client.insert,
                 collection_name=self.COLLECTION_NAME,
-                data={
-                    "id": doc["id"],
-                    "vector": embedding,  # Removed the extra list wrapper
-                    "text": doc["text"],
-                },
+                data=rows[start : start + self.MAX_INSERT_ROWS],
             )
 
+        # Cached search results may no longer be the best matches
+        self.semantic_cache.clear()
+
         print(f"Added {len(documents)} documents to the index")
 
-    def search(self, query: str, limit: int = 3) -> List[Dict]:
+    async def search(
+        self,
+        query: str,
+        limit: int = 3,
+        fetch_text: bool = True,
+        score_threshold: Optional[float] = None,
+    ) -> List[Dict]:
         """
         Search for similar documents
         query: Search query
         limit: Number of results to return
+        fetch_text: Return document text with each hit; when False only ids
+            and distances come back, and texts can be fetched with get_texts
+        score_threshold: Only return hits scoring above this cosine similarity,
+            filtered by Milvus as a range search
         """
-        # Get embedding for the query
-        query_embedding = self._get_embedding(query)
+        # Get embedding for the query, normalized to match the stored vectors
+        query_embedding = normalize(await self._get_query_embedding(query))
+
+        # Reuse results of a previous, near-identical query; their distances
+        # belong to that query, so thresholded searches always go to Milvus
+        if score_threshold is None:
+            cached = self.semantic_cache.get(query_embedding, limit)
+            if cached is not None:
+                return cached
 
-        # Search in Milvus
-        results = self.milvus_client.search(
+        # Search in Milvus off the event loop, so concurrent searches overlap
+        results = await asyncio.to_thread(
+            self.milvus_client.search,
             collection_name=self.COLLECTION_NAME,
             data=[query_embedding],
             limit=limit,
-            output_fields=["text"],
+            output_fields=["text"] if fetch_text else None,
+            search_params=self._search_params(limit, score_threshold),
         )
 
+        # Only cache complete, unfiltered hits so any later lookup can use them
+        if fetch_text and score_threshold is None:
+            self.semantic_cache.put(query_embedding, limit, results[0])
         return results[0]  # Return first (and only) query's results
 
+    async def search_many(
+        self, queries: List[str], limit: int = 3, fetch_text: bool = True
+    ) -> List[List[Dict]]:
+        """
+        Search for similar documents for several queries in one round trip
+        queries: Search queries
+        limit: Number of results to return per query
+        fetch_text: Return document text with each hit, as in search
+        """
+        if not queries:
+            return []
+
+        # Embed the queries in as few requests as the API limits allow
+        query_vectors = await self._embed_texts(queries)
+
+        # Search in Milvus; results hold one list of hits per query, in order
+        return await asyncio.to_thread(
+            self.milvus_client.search,
+            collection_name=self.COLLECTION_NAME,
+            data=list(query_vectors),
+            limit=limit,
+            output_fields=["text"] if fetch_text else None,
+            search_params=self._search_params(limit),
+        )
+
+    async def get_texts(self, ids: List[int]) -> Dict[int, str]:
+        """
+        Fetch document texts by id in a single request
+        ids: Document ids, e.g. from a search with fetch_text=False
+        """
+        if not ids:
+            return {}
+
+        records = await asyncio.to_thread(
+            self.milvus_client.get,
+            collection_name=self.COLLECTION_NAME,
+            ids=ids,
+            output_fields=["text"],
+        )
+        return {record["id"]: record["text"] for record in records}
+
+    def _search_params(
+        self, limit: int, score_threshold: Optional[float] = None
+    ) -> Dict:
+        """
+        HNSW search parameters; ef must be at least the number of results
+        metric_type is left out so Milvus uses the index's own metric, which
+        keeps collections created before the switch to IP (COSINE) searchable
+        """
+        params = {"ef": max(self.HNSW_EF, limit)}
+        if score_threshold is not None:
+            # With IP or COSINE, a range search keeps hits scoring above radius
+            params["radius"] = score_threshold
+        return {"params": params}
 
-def main():
-    # Initialize semantic search
-    search_engine = SemanticSearch()
 
+async def main():
     # Example documents
     documents = [
         {
@@ -141,31 +622,32 @@ def main():
         },
     ]
 
-    # Add documents to the index
-    search_engine.add_documents(documents)
+    # Initialize semantic search; leaving the block closes its connections
+    async with SemanticSearch() as search_engine:
+        # Add documents to the index
+        await search_engine.add_documents(documents)
 
-    while True:
-        # Get query from user
-        query = input("\nEnter your search query (or 'quit' to exit): ").strip()
+        while True:
+            # Get query from user
+            query = input("\nEnter your search query (or 'quit' to exit): ").strip()
 
-        if query.lower() in ["quit", "exit", "q"]:
-            break
+            if query.lower() in ["quit", "exit", "q"]:
+                break
 
-        if not query:
-            continue
+            if not query:
+                continue
 
-        # Perform search
-        results = search_engine.search(query, limit=2)
+            # Perform search
+            results = await search_engine.search(query, limit=2)
 
-        print("\nSearch Results for:", query)
-        print("-" * 50)
-        for result in results:
-            print(
-                f"Score: {-result['distance']:.4f}"
-            )  # Convert distance to similarity score
-            print(f"Text: {result['entity']['text']}")
+            print("\nSearch Results for:", query)
             print("-" * 50)
+            for result in results:
+                # IP distance is the similarity
+                print(f"Score: {result['distance']:.4f}")
+                print(f"Text: {result['entity']['text']}")
+                print("-" * 50)
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())